@@ -96,13 +96,19 @@ class Spacing(Transform):
         transform_ = to_affine_nd(sr, transform)
         # resample
         dtype = data_array.dtype if self.dtype is None else self.dtype
-        output_data = []
-        for data in data_array:
-            data_ = scipy.ndimage.affine_transform(
-                data.astype(dtype), matrix=transform_, output_shape=output_shape,
-                order=interp_order, mode=self.mode, cval=self.cval)
-            output_data.append(data_)
-        output_data = np.stack(output_data)
+        data_array = np.asarray(data_array)
+        output_shape = (len(data_array),) + tuple(output_shape)
+        if output_shape == data_array.shape and np.array_equal(transform_, np.eye(sr + 1)):
+            # the input is already sampled on the output grid; the check is exact because
+            # any tolerance would also skip small but real changes of spacing
+            output_data = data_array.astype(dtype)
+        else:
+            # resample the channels one by one into a preallocated output
+            output_data = np.empty(output_shape, dtype=dtype)
+            for data, data_ in zip(data_array.astype(dtype, copy=False), output_data):
+                scipy.ndimage.affine_transform(
+                    data, matrix=transform_, output=data_,
+                    order=interp_order, mode=self.mode, cval=self.cval)
         new_affine = to_affine_nd(affine, new_affine)
         return output_data, affine, new_affine
 